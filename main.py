@@ -1,18 +1,26 @@
 import os
 import hmac
+import time
+import asyncio
 import hashlib
-from typing import Any, Dict, Optional
+import logging
+import functools
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
-from fastapi.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
+import httpx
+import orjson
+import asyncpg
+from cachetools import TTLCache
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 
 
 # =========================
 # Utils
 # =========================
 
+@functools.cache
 def get_env(name: str, required: bool = True, default: Optional[str] = None) -> str:
     value = os.environ.get(name, default)
     if required and not value:
@@ -28,23 +36,115 @@ SUPABASE_URL = get_env("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = get_env("SUPABASE_SERVICE_ROLE_KEY")
 
 # Optional : secret de signature FeexPay
-FEEPAY_WEBHOOK_SECRET = os.environ.get("FEEPAY_WEBHOOK_SECRET", "")
+FEEPAY_WEBHOOK_SECRET = get_env("FEEPAY_WEBHOOK_SECRET", required=False)
+SECRET_BYTES = FEEPAY_WEBHOOK_SECRET.encode() if FEEPAY_WEBHOOK_SECRET else None
+NO_SECRET = SECRET_BYTES is None
+
+# Optional : connexion Postgres directe (asyncpg), sinon écriture via PostgREST.
+# Connexion directe ou pooler en mode session : le mode transaction
+# ne conserve pas les requêtes préparées.
+SUPABASE_DB_URL = get_env("SUPABASE_DB_URL", required=False)
+
+# Contexte HMAC dont la clé (ipad/opad) est dérivée une seule fois ;
+# chaque requête en fait une copie C-level au lieu de re-dériver la clé.
+_signature_mac = (
+    None if NO_SECRET else hmac.new(SECRET_BYTES, digestmod=hashlib.sha256)
+)
+
+# Client PostgREST unique : connexions HTTP/2 gardées ouvertes entre les
+# webhooks (pas de handshake TLS par requête), fermé à l'arrêt (lifespan).
+# Les limites se règlent sur le transport, le client les ignorerait.
+postgrest = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+    headers={
+        "apikey": SUPABASE_SERVICE_ROLE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    },
+    timeout=httpx.Timeout(5.0, connect=2.0),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=1,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    ),
+)
+
+# Écritures en attente, réparties sur ORDER_WORKERS files (une par worker).
+# Une commande passe toujours par la même file : ses webhooks sont écrits
+# dans leur ordre d'arrivée.
+ORDER_QUEUE_SIZE = 10_000
+ORDER_WORKERS = 4
+
+# File pleine : attente maximale d'une place avant de répondre 503 (s)
+ORDER_ENQUEUE_TIMEOUT = 1.0
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+# Backoff des écritures en erreur transitoire (s)
+ORDER_RETRY_DELAY = 0.5
+ORDER_RETRY_MAX_DELAY = 30.0
+
+# Arrêt : temps laissé aux workers pour vider les files (s)
+ORDER_DRAIN_TIMEOUT = 20.0
+
+# Un worker regroupe jusqu'à ORDER_BATCH_SIZE lignes arrivées
+# dans les ORDER_BATCH_WAIT secondes en un seul upsert
+ORDER_BATCH_SIZE = 200
+ORDER_BATCH_WAIT = 0.02
+order_queues: List["asyncio.Queue[Dict[str, Any]]"] = []
+
+# Pool asyncpg, créé au démarrage si SUPABASE_DB_URL est défini
+db_pool: Optional[asyncpg.Pool] = None
+
+logger = logging.getLogger("feexpay-webhook")
 
 
 # =========================
 # App
 # =========================
 
-app = FastAPI(title="FeexPay Webhook", version="1.0.0")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=False,
-    allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["*"],
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    global order_queues, db_pool
+    if SUPABASE_DB_URL:
+        db_pool = await asyncpg.create_pool(
+            SUPABASE_DB_URL,
+            min_size=5,
+            max_size=20,
+            statement_cache_size=100,
+        )
+    order_queues = [
+        asyncio.Queue(maxsize=ORDER_QUEUE_SIZE // ORDER_WORKERS)
+        for _ in range(ORDER_WORKERS)
+    ]
+    workers = [asyncio.create_task(order_worker(queue)) for queue in order_queues]
+    try:
+        yield
+    finally:
+        # Les webhooks déjà acquittés sont écrits avant l'arrêt, dans la
+        # limite de ORDER_DRAIN_TIMEOUT ; le reste est journalisé pour rejeu
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in order_queues)),
+                ORDER_DRAIN_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            pass
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for queue in order_queues:
+            while not queue.empty():
+                log_dropped_order(queue.get_nowait(), "not written before shutdown")
+        await postgrest.aclose()
+        if db_pool is not None:
+            await db_pool.close()
+            db_pool = None
+        order_queues = []
+
+
+app = FastAPI(
+    title="FeexPay Webhook",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 
@@ -74,131 +174,326 @@ def health() -> Dict[str, Any]:
 # Sécurité signature
 # =========================
 
-def constant_time_compare(a: str, b: str) -> bool:
-    return hmac.compare_digest(a.encode(), b.encode())
+# Taille maximale d'un corps de webhook, vérifiée avant toute lecture ou HMAC
+MAX_BODY_SIZE = 64 * 1024
+
+# Écart maximal accepté entre X-Feexpay-Timestamp et l'horloge locale (s)
+SIGNATURE_TOLERANCE = 300
+
+# Débit de livraisons signées que le cache anti-rejeu couvre sans perte (par s)
+SIGNATURE_MAX_RATE = 100
+
+# Signatures déjà traitées : un rejeu est refusé sans recalculer le HMAC.
+# Le TTL couvre toute la fenêtre [ts - tolérance, ts + tolérance] et la taille
+# tout ce qu'elle contient à SIGNATURE_MAX_RATE ; au-delà, le LRU évincerait
+# des signatures encore valides et un rejeu redeviendrait possible.
+_seen_signatures: TTLCache = TTLCache(
+    maxsize=SIGNATURE_MAX_RATE * 2 * SIGNATURE_TOLERANCE,
+    ttl=2 * SIGNATURE_TOLERANCE,
+)
 
 
-def verify_signature(raw_body: bytes, provided_sig: Optional[str]) -> None:
+def verify_signature(
+    raw_body: bytes,
+    provided_sig: Optional[str],
+    timestamp: Optional[str],
+) -> Optional[str]:
+    """
+    Retourne la raison du refus, ou None si la livraison est authentique
+    """
     # Si aucun secret n'est configuré, on skip (mode permissif)
-    if not FEEPAY_WEBHOOK_SECRET:
-        return
+    if NO_SECRET:
+        return None
 
     if not provided_sig:
-        raise HTTPException(status_code=401, detail="Missing signature header")
+        return "Missing signature header"
+    if not timestamp:
+        return "Missing timestamp header"
 
-    expected = hmac.new(
-        FEEPAY_WEBHOOK_SECRET.encode(),
-        raw_body,
-        hashlib.sha256
-    ).hexdigest()
+    try:
+        ts = int(timestamp)
+    except ValueError:
+        return "Invalid timestamp header"
+    if abs(time.time() - ts) > SIGNATURE_TOLERANCE:
+        return "Expired timestamp"
 
-    if not constant_time_compare(provided_sig, expected):
-        raise HTTPException(status_code=401, detail="Invalid signature")
+    try:
+        provided = bytes.fromhex(provided_sig.strip())
+    except ValueError:
+        return "Invalid signature"
+
+    # Indexé sur le digest décodé : changer la casse de l'hex ne contourne pas le rejeu
+    if provided in _seen_signatures:
+        return "Replayed signature"
+
+    # Le timestamp est signé avec le corps : "<ts>.<raw_body>"
+    mac = _signature_mac.copy()
+    mac.update(timestamp.encode())
+    mac.update(b".")
+    mac.update(raw_body)
+
+    if not hmac.compare_digest(provided, mac.digest()):
+        return "Invalid signature"
+
+    return None
+
+
+def remember_signature(provided_sig: Optional[str], timestamp: Optional[str]) -> None:
+    """
+    Marque une signature vérifiée comme utilisée, une fois le webhook mis en
+    file : une livraison refusée (503) peut ainsi être renvoyée telle quelle
+    """
+    if NO_SECRET:
+        return
+    _seen_signatures[bytes.fromhex(provided_sig.strip())] = int(timestamp)
 
 
 # =========================
 # Business logic
 # =========================
 
-def map_payment_status(provider_status: str) -> str:
-    normalized = (provider_status or "").upper()
+# Webhooks déjà appliqués : ligne écrite (JSON canonique) -> 1
+# Seule une relivraison à l'identique est ignorée : un webhook qui apporte
+# une donnée nouvelle (order_number, montant...) est toujours écrit.
+# Pas de verrou : la boucle asyncio est mono-thread et le cache n'est
+# modifié qu'entre deux await.
+_applied_webhooks: TTLCache = TTLCache(maxsize=10_000, ttl=600)
+
+
+# Statut fournisseur (en majuscules) -> statut applicatif
+_PAYMENT_STATUS = {
+    "SUCCESS": "confirmed",
+    "SUCCESSFUL": "confirmed",
+    "COMPLETED": "confirmed",
+    "FAIL": "failed",
+    "FAILED": "failed",
+    "CANCELED": "failed",
+    "CANCELLED": "failed",
+}
 
-    if normalized in ("SUCCESS", "SUCCESSFUL", "COMPLETED"):
-        return "confirmed"
-    if normalized in ("FAIL", "FAILED", "CANCELED", "CANCELLED"):
-        return "failed"
-    return "pending"
+
+def map_payment_status(provider_status: str) -> str:
+    return _PAYMENT_STATUS.get((provider_status or "").upper(), "pending")
 
 
-def upsert_order(payload: Dict[str, Any]) -> None:
+def build_order_row(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     tx_id = payload.get("transaction_id") or payload.get("reference")
     order_ref = payload.get("order_number") or payload.get("reference")
     provider_status = payload.get("status") or payload.get("payment_status")
     provider_name = payload.get("payment_provider") or "feexpay"
 
     if not tx_id and not order_ref:
-        raise HTTPException(
-            status_code=400,
-            detail="transaction_id or order_number is required"
-        )
+        return None
+
+    # Webhook signé mais mal formé : refusé (400) plutôt qu'une exception
+    # plus loin, dont le 500 serait rejoué sans fin par FeexPay
+    for value in (tx_id, order_ref, provider_status, provider_name):
+        if value is not None and not isinstance(value, str):
+            return None
+    amount = payload.get("amount")
+    if amount is not None and (
+        isinstance(amount, bool) or not isinstance(amount, (int, float, str))
+    ):
+        return None
+
+    row = {
+        "transaction_id": tx_id,
+        "payment_reference": order_ref,
+        "payment_provider": provider_name,
+        "payment_status": provider_status,
+        "status": map_payment_status(provider_status or ""),
+    }
+    # Sans référence commande, on ne touche pas au order_number existant
+    if order_ref:
+        row["order_number"] = order_ref
+    if amount is not None:
+        row["total_amount"] = amount
+    return row
 
-    status_app = map_payment_status(provider_status or "")
 
-    # 1️⃣ Update par order_number
-    if order_ref:
-        existing = (
-            supabase.table("orders")
-            .select("id")
-            .eq("order_number", order_ref)
-            .limit(1)
-            .execute()
-        )
-        if existing.data:
-            supabase.table("orders").update({
-                "transaction_id": tx_id,
-                "payment_reference": order_ref,
-                "payment_provider": provider_name,
-                "payment_status": provider_status,
-                "status": status_app,
-            }).eq("order_number", order_ref).execute()
-            return
+def _applied_key(row: Dict[str, Any]) -> bytes:
+    return orjson.dumps(row, option=orjson.OPT_SORT_KEYS)
+
+
+async def upsert_orders(rows: List[Dict[str, Any]]) -> None:
+    pending = [row for row in rows if _applied_key(row) not in _applied_webhooks]
+    if not pending:
+        return
 
-    # 2️⃣ Update par transaction_id
-    if tx_id:
-        existing_tx = (
-            supabase.table("orders")
-            .select("id")
-            .eq("transaction_id", tx_id)
-            .limit(1)
-            .execute()
+    # Update par order_number / transaction_id ou insert, décidé côté Postgres
+    # en un seul aller-retour (fonction : sql/feexpay_apply.sql)
+    if db_pool is not None:
+        # Préparée une fois par connexion (cache d'asyncpg), puis EXECUTE seul
+        async with db_pool.acquire() as conn:
+            await conn.execute(
+                "select public.feexpay_apply($1::jsonb)",
+                orjson.dumps(pending).decode(),
+            )
+    else:
+        resp = await postgrest.post(
+            "/rpc/feexpay_apply",
+            json={"rows": pending},
+            headers={"Prefer": "return=minimal"},
         )
-        if existing_tx.data:
-            supabase.table("orders").update({
-                "payment_reference": order_ref,
-                "payment_provider": provider_name,
-                "payment_status": provider_status,
-                "status": status_app,
-            }).eq("transaction_id", tx_id).execute()
+        resp.raise_for_status()
+
+    for row in pending:
+        _applied_webhooks[_applied_key(row)] = 1
+
+
+async def fill_order_batch(
+    queue: "asyncio.Queue[Dict[str, Any]]",
+    batch: List[Dict[str, Any]],
+) -> None:
+    # Remplit le lot de l'appelant au fil de l'eau : une annulation pendant
+    # l'attente laisse les lignes déjà retirées de la file dans le lot
+    batch.append(await queue.get())
+    if queue.qsize() < ORDER_BATCH_SIZE - 1:
+        await asyncio.sleep(ORDER_BATCH_WAIT)
+    while len(batch) < ORDER_BATCH_SIZE:
+        try:
+            batch.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+
+
+def order_queue_for(row: Dict[str, Any]) -> "asyncio.Queue[Dict[str, Any]]":
+    key = row["transaction_id"] or row.get("order_number")
+    return order_queues[hash(key) % len(order_queues)]
+
+
+def is_transient_error(exc: Exception) -> bool:
+    """
+    Erreur qu'un nouvel essai peut résoudre. Seules les données refusées pour
+    une ligne sont définitives ; une migration manquante ou une clé invalide
+    (404, 401/403, 42883...) touche tout le déploiement : on garde les lignes.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code not in (400, 409, 422)
+    if isinstance(exc, asyncpg.PostgresError):
+        # Classes 22 / 23 : données invalides ou contrainte violée
+        return (exc.sqlstate or "")[:2] not in ("22", "23")
+    return True
+
+
+def log_dropped_order(row: Dict[str, Any], reason: Any) -> None:
+    logger.error(
+        "Dropping FeexPay webhook %s: %s", orjson.dumps(row).decode(), reason
+    )
+
+
+async def apply_orders(rows: List[Dict[str, Any]]) -> None:
+    # Erreur transitoire : tout le lot est réessayé sur place avec backoff,
+    # plutôt que remis en fin de file ou éclaté en autant de requêtes vouées
+    # à l'échec ; un webhook plus récent de la même commande attend derrière.
+    delay = ORDER_RETRY_DELAY
+    while True:
+        try:
+            await upsert_orders(rows)
             return
+        except Exception as e:
+            if not is_transient_error(e):
+                error = e
+                break
+            logger.warning(
+                "Failed to apply %d FeexPay webhook(s), retrying in %.1fs: %s",
+                len(rows), delay, e,
+            )
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, ORDER_RETRY_MAX_DELAY)
+
+    # Erreur permanente : on reprend ligne par ligne pour n'écarter que les
+    # lignes réellement en erreur
+    if len(rows) > 1:
+        for row in rows:
+            await apply_orders([row])
+        return
+    log_dropped_order(rows[0], error)
 
-    # 3️⃣ Insert minimal si inexistant
-    supabase.table("orders").insert({
-        "order_number": order_ref,
-        "transaction_id": tx_id,
-        "payment_reference": order_ref,
-        "payment_provider": provider_name,
-        "payment_status": provider_status,
-        "status": status_app,
-        "total_amount": payload.get("amount"),
-        "notes": "Created by FeexPay webhook",
-    }).execute()
+
+async def order_worker(queue: "asyncio.Queue[Dict[str, Any]]") -> None:
+    while True:
+        batch: List[Dict[str, Any]] = []
+        try:
+            await fill_order_batch(queue, batch)
+            await apply_orders(batch)
+        except asyncio.CancelledError:
+            for row in batch:
+                log_dropped_order(row, "not written before shutdown")
+            raise
+        finally:
+            for _ in batch:
+                queue.task_done()
 
 
 # =========================
 # Webhook FeexPay
 # =========================
 
+async def read_body(request: Request) -> Optional[bytes]:
+    """
+    Lit le corps une seule fois depuis le canal ASGI, ou None s'il dépasse
+    MAX_BODY_SIZE (y compris les corps chunked, sans Content-Length)
+    """
+    chunks: List[bytes] = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
 @app.post("/webhooks/feexpay")
-async def feexpay_webhook(request: Request) -> JSONResponse:
-    raw_body = await request.body()
+async def feexpay_webhook(request: Request) -> ORJSONResponse:
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_BODY_SIZE:
+        return ORJSONResponse({"detail": "Payload too large"}, status_code=413)
+
+    raw_body = await read_body(request)
+    if raw_body is None:
+        return ORJSONResponse({"detail": "Payload too large"}, status_code=413)
 
     signature = (
         request.headers.get("X-Feexpay-Signature")
         or request.headers.get("X-Signature")
     )
 
-    verify_signature(raw_body, signature)
+    timestamp = request.headers.get("X-Feexpay-Timestamp")
 
-    try:
-        payload = await request.json()
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    # Refus renvoyés directement : pas d'exception sur le chemin d'erreur
+    reason = verify_signature(raw_body, signature, timestamp)
+    if reason is not None:
+        return ORJSONResponse({"detail": reason}, status_code=401)
 
+    # Signature et parsing portent sur les mêmes octets, lus une seule fois
     try:
-        upsert_order(payload)
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        payload = orjson.loads(raw_body)
+    except orjson.JSONDecodeError:
+        payload = None
+    if not isinstance(payload, dict):
+        return ORJSONResponse({"detail": "Invalid JSON body"}, status_code=400)
+
+    row = build_order_row(payload)
+    if row is None:
+        return ORJSONResponse(
+            {"detail": "transaction_id or order_number is required, "
+                       "with string references and status"},
+            status_code=400,
+        )
 
-    return JSONResponse({"ok": True})
+    # Acquittement dès la mise en file : l'écriture est faite par les workers.
+    # File pleine : pas d'écriture en ligne, qui doublerait les webhooks
+    # de la même commande encore en file ; 503 et FeexPay réessaie.
+    queue = order_queue_for(row)
+    try:
+        queue.put_nowait(row)
+    except asyncio.QueueFull:
+        try:
+            await asyncio.wait_for(queue.put(row), ORDER_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return ORJSONResponse({"detail": "Queue full"}, status_code=503)
+
+    remember_signature(signature, timestamp)
+    return ORJSONResponse({"ok": True})
@@ -0,0 +1,59 @@
+-- Applique un lot de webhooks FeexPay en un seul appel
+-- (POST /rest/v1/rpc/feexpay_apply, corps {"rows": [...]}).
+-- Pour chaque ligne, dans l'ordre de réception :
+--   1. update par order_number
+--   2. sinon update par transaction_id
+--   3. sinon insert minimal
+-- jsonb_populate_record type chaque champ selon la colonne de public.orders.
+
+create or replace function public.feexpay_apply(rows jsonb)
+returns void
+language plpgsql
+as $$
+declare
+    r jsonb;
+    o public.orders;
+begin
+    for r in select value from jsonb_array_elements(rows)
+    loop
+        o := jsonb_populate_record(null::public.orders, r);
+
+        -- 1️⃣ Update par order_number
+        if o.order_number is not null then
+            update public.orders set
+                transaction_id = o.transaction_id,
+                payment_reference = o.payment_reference,
+                payment_provider = o.payment_provider,
+                payment_status = o.payment_status,
+                status = o.status
+            where order_number = o.order_number;
+            continue when found;
+        end if;
+
+        -- 2️⃣ Update par transaction_id
+        if o.transaction_id is not null then
+            update public.orders set
+                payment_reference = o.payment_reference,
+                payment_provider = o.payment_provider,
+                payment_status = o.payment_status,
+                status = o.status
+            where transaction_id = o.transaction_id;
+            continue when found;
+        end if;
+
+        -- 3️⃣ Insert minimal si inexistant
+        insert into public.orders (
+            order_number, transaction_id, payment_reference,
+            payment_provider, payment_status, status, total_amount, notes
+        ) values (
+            o.order_number, o.transaction_id, o.payment_reference,
+            o.payment_provider, o.payment_status, o.status, o.total_amount,
+            'Created by FeexPay webhook'
+        );
+    end loop;
+end;
+$$;
+
+-- Supabase expose les fonctions RPC à anon/authenticated par défaut
+revoke execute on function public.feexpay_apply(jsonb) from public, anon, authenticated;
+grant execute on function public.feexpay_apply(jsonb) to service_role;
@@ -0,0 +1,10 @@
+-- Index de recherche de feexpay_apply (sql/feexpay_apply.sql), volontairement
+-- non uniques : un webhook peut rattacher à une commande un transaction_id déjà
+-- présent sur une ligne créée par un webhook précédent, et des doublons
+-- existants ne doivent pas bloquer la migration.
+
+create index if not exists orders_order_number_idx
+    on public.orders (order_number);
+
+create index if not exists orders_transaction_id_idx
+    on public.orders (transaction_id);